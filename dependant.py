@@ -1,11 +1,36 @@
-from lark import Lark, Transformer
+from lark import Lark, Token, Transformer, Tree
+from lark.visitors import Interpreter
 from typing import Any
 from typecheck import *
 
 with open("grammar.lark") as f:
     grammar = f.read()
 
-parser = Lark(grammar)
+class DeclLayout:
+  # a `name = term` declaration ends at the next line starting in column 0,
+  # which is what lets the LALR parser tell it apart from the final term
+  always_accept = ("_NL",)
+  def process(self, stream):
+    in_decl = False
+    for tok in stream:
+      if tok.type == "_NL":
+        if in_decl and tok.value.endswith("\n"):
+          in_decl = False
+          yield Token.new_borrow_pos("_DECL_END", tok.value, tok)
+        continue
+      if tok.type == "EQUAL":
+        in_decl = True
+      yield tok
+
+parser = Lark(
+  grammar,
+  parser="lalr",
+  lexer="contextual",
+  postlex=DeclLayout(),
+  cache=".lark_cache",
+  maybe_placeholders=False,
+  propagate_positions=False,
+)
 
 class GetDataDecls(Transformer):
   def __init__(self, context: Context):
@@ -14,26 +39,24 @@ class GetDataDecls(Transformer):
     return self.context
   def data_decl(self, args):
     name, params, ret, constructors = args
-    cons = self.context.mapping
-    to_term = ToTerm()
     for con in constructors.children:
       con_name, con_type = con.children
-      cons[con_name.value] = to_term.transform(con_type)
-    this = to_term.transform(ret)
-    for p in reversed(params.children):
+      self.context.define(con_name.value, to_term(con_type))
+    this = to_term(ret)
+    telescope = []
+    for p in params.children:
       n, t = p.children
-      this = DependantType(n.value, t, this)
-    cons[name.value] = this
+      telescope.append((n.value, to_term(t)))
+    if telescope:
+      this = Telescope(tuple(telescope), this)
+    self.context.define(name.value, this)
   def var_decl(self, args):
     name, type, _, value = args
-    to_term = ToTerm()
-    type = to_term.transform(type)
-    value = to_term.transform(value)
-    s, value = value.infer(self.context)
-    cons = self.context.mapping
-    s = s(unify(value, type))
+    type = to_term(type)
+    _, value = InferTerm(self.context).visit(value)
+    s = unify(value, type)
     assert s
-    cons[name.value] = s(type)
+    self.context.define(name.value, s(type))
 
 class ToTerm(Transformer):
     def application(self, args):
@@ -56,8 +79,74 @@ class ToTerm(Transformer):
         return Nat(int(args[0].value))
     def NAME(self, token):
         return token.value
+    def BINDER(self, token):
+        return token.value
     def TYPE_NAME(self, token):
         return token.value
+
+def compile_transformer(transformer: Transformer, parser: Lark):
+    # specializes `transformer.transform` to this grammar: the generated
+    # function tests rule and terminal names in turn and calls the bound
+    # callbacks directly, with no per-node getattr or Transformer dispatch
+    rules = sorted({str(r.alias or r.origin.name) for r in parser.rules})
+    rules = [r for r in rules if hasattr(transformer, r)]
+    terminals = [t.name for t in parser.terminals if hasattr(transformer, t.name)]
+    src = ["def transform(node):", "    if isinstance(node, Token):"]
+    src += [f"        if node.type == {t!r}: return _{t}(node)" for t in terminals]
+    src += [
+        "        return node",
+        "    data = node.data",
+        "    children = [transform(c) for c in node.children]",
+    ]
+    src += [f"    if data == {r!r}: return _{r}(children)" for r in rules]
+    src += ["    return Tree(data, children)"]
+    namespace = {"Token": Token, "Tree": Tree}
+    for name in rules + terminals:
+        namespace[f"_{name}"] = getattr(transformer, name)
+    exec(compile("\n".join(src), f"<{type(transformer).__name__}>", "exec"), namespace)
+    return namespace["transform"]
+
+to_term = compile_transformer(ToTerm(), parser)
+
+class InferTerm(Interpreter):
+    # infers straight from the parse tree instead of building a Term first;
+    # only binder annotations are converted, since they end up in types.
+    # Rules dispatch through `rule` rather than Interpreter.visit, so each
+    # level of nesting costs one Python frame, as it does in Term.infer
+    def __init__(self, context: Context):
+        self.context = context
+    def abstraction(self, tree):
+        param, type, body = tree.children
+        type = to_term(type)
+        with self.context.extend(param.value, type):
+            result = self.rule(body)(body)
+        return infer_abstraction(type, result)
+    def application(self, tree):
+        # `f a b` nests to the left, so the spine is walked in a loop and
+        # only the arguments recurse
+        args = []
+        while tree.data == "application":
+            tree, arg = tree.children
+            args.append(arg)
+        result = self.rule(tree)(tree)
+        for arg in reversed(args):
+            if isinstance(result, str): return result
+            result = infer_application(result, self.rule(arg)(arg))
+        return result
+    def dependant_type(self, tree):
+        param, term, body = tree.children
+        result = self.rule(term)(term)
+        if isinstance(result, str): return result
+        _, t1 = result
+        with self.context.extend(param.value, t1):
+            result = self.rule(body)(body)
+        return infer_dependant(param.value, t1, result)
+    def var(self, tree):
+        return infer_var(tree.children[0].value, self.context)
+    def rule(self, tree):
+        return getattr(self, tree.data, self.__default__)
+    def __default__(self, tree):
+        return to_term(tree).infer(self.context)
     
 with open("demo.dep") as f:
     code = f.read()
@@ -65,7 +154,7 @@ with open("demo.dep") as f:
 tree = parser.parse(code)
 context = GetDataDecls(Context({})).transform(tree)
 tree: Any = tree.children[-1]
-result = ToTerm().transform(tree).infer(context)
+result = InferTerm(context).visit(tree)
 if isinstance(result, str):
     print(f"ERROR: {result}")
 else:
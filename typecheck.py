@@ -1,5 +1,8 @@
-from typing import Optional, overload, TypeAlias, Union
+from typing import Optional, TypeAlias, Union
 from abc import ABC, abstractmethod
+from contextlib import ExitStack
+from types import MappingProxyType
+from weakref import WeakValueDictionary
 
 Term: TypeAlias = Union[
   'Var',
@@ -9,22 +12,41 @@ Term: TypeAlias = Union[
   'Abstraction',
   'Application',
   'WildCard',
+  'Telescope',
 ]
 
 InferenceResult: TypeAlias = tuple['Substitution', Term] | str
 
 class Inferrable(ABC):
+    __slots__ = ()
     @abstractmethod
     def infer(self, context: 'Context') -> InferenceResult: ...
 
+_CONS_CACHE: WeakValueDictionary[tuple, 'TypeConstructor'] = WeakValueDictionary()
+_NAT_CACHE: WeakValueDictionary[int, 'Nat'] = WeakValueDictionary()
+# literals this small are kept alive for the whole run instead of being
+# reinterned every time the last reference to one goes away
+_SMALL_NATS: dict[int, 'Nat'] = {}
+_DEP_CACHE: WeakValueDictionary[tuple, 'DependantType'] = WeakValueDictionary()
+_TEL_CACHE: WeakValueDictionary[tuple, 'Telescope'] = WeakValueDictionary()
+
 class TypeConstructor(Inferrable):
-    def __init__(self, name: str, args: list[Term] = []) -> None:
-        self.name = name
-        self.args = args
+    __slots__ = ("name", "args", "__weakref__")
+    KIND = 1
+    def __new__(cls, name: str, args: Optional[list[Term]] = None) -> 'TypeConstructor':
+        if args is None: args = []
+        key = (name, tuple(id(a) for a in args))
+        self = _CONS_CACHE.get(key)
+        if self is None:
+            self = super().__new__(cls)
+            self.name = name
+            self.args = args
+            _CONS_CACHE[key] = self
+        return self
     def infer(self, context: 'Context') -> InferenceResult:
         if not context.mapping.get(self.name):
           return "not found: " + self.name
-        return Substitution(), context.mapping[self.name]
+        return _EMPTY_SUBST, context.instantiate(self.name)
     def __repr__(self) -> str:
         if self.name == "->":
             l = str(self.args[0])
@@ -36,60 +58,86 @@ class TypeConstructor(Inferrable):
         return f"{self.name}{args}"
     
 class Nat(Inferrable):
-    def __init__(self, value: int) -> None:
-        self.value = value
+    __slots__ = ("value", "__weakref__")
+    KIND = 3
+    def __new__(cls, value: int) -> 'Nat':
+        self = _SMALL_NATS.get(value)
+        if self is not None:
+            return self
+        self = _NAT_CACHE.get(value)
+        if self is None:
+            self = super().__new__(cls)
+            self.value = value
+            if -1 <= value <= 256:
+                _SMALL_NATS[value] = self
+            else:
+                _NAT_CACHE[value] = self
+        return self
     def infer(self, context: 'Context') -> InferenceResult:
         context = context
-        return Substitution(), TypeConstructor("Nat")
+        return _NAT_RESULT
     def __repr__(self) -> str:
         return f"{self.value}"
 
 class Var(Inferrable):
+    __slots__ = ("id", "_fresh", "_name")
+    KIND = 0
     var_count = 0
-    def __init__(self, name: Optional[str] = None) -> None:
+    id_count = 0
+    ids: dict[str, int] = {}
+    def __init__(self, name: Optional[str] = None, fresh: bool = False) -> None:
+        # variables are identified by an integer id; named ones share the
+        # id of their name unless `fresh`, unnamed ones only format a name
+        # when printed
         if not name:
             Var.var_count += 1
-            name = f"t{Var.var_count}"
-        self.name = name
+            self._fresh = Var.var_count
+            self.id = Var.id_count
+            Var.id_count += 1
+        elif name in Var.ids and not fresh:
+            self._fresh = 0
+            self.id = Var.ids[name]
+        else:
+            self._fresh = 0
+            self.id = Var.id_count
+            Var.id_count += 1
+            if not fresh:
+                Var.ids[name] = self.id
+        self._name = name
+    @property
+    def name(self) -> str:
+        if self._name is None:
+            self._name = f"t{self._fresh}"
+        return self._name
     def infer(self, context: 'Context') -> InferenceResult:
-        if self.name in context.mapping:
-            return Substitution(), context.mapping[self.name]
-        return f"Unbound variable: {self}"
+        return infer_var(self.name, context)
     def __repr__(self) -> str:
         return self.name
 
 class Abstraction(Inferrable):
+    __slots__ = ("param", "type", "body")
+    KIND = 4
     def __init__(self, param: str, type: Term, body: Term) -> None:
         self.param = param
         self.type = type
         self.body = body
     def infer(self, context: 'Context') -> InferenceResult:
-        context = Context(context.mapping.copy())
-        context.mapping[self.param] = self.type
-        result = self.body.infer(context)
-        if isinstance(result, str): return result
-        s2, t1 = result
-        return s2, TypeConstructor("->", [self.type, t1])
+        with context.extend(self.param, self.type):
+            result = self.body.infer(context)
+        return infer_abstraction(self.type, result)
     def __repr__(self):
         return f"\\{self.param}: {self.type}. {self.body}"
 
 class Application(Inferrable):
+    __slots__ = ("func", "arg")
+    KIND = 5
     def __init__(self, func: Term, arg: Term) -> None:
         self.func = func
         self.arg = arg
     def infer(self, context: 'Context') -> InferenceResult:
         result = self.func.infer(context)
         if isinstance(result, str): return result
-        s1, t1 = result
-        result = self.arg.infer(context)
-        if isinstance(result, str): return result
-        s2, t2 = result
-        beta = Var()
-        fn = TypeConstructor("->", [t2, beta])
-        s3 = unify(t1, fn)
-        if s3 is None:
-            return f"Failed unification of function types: '{t1}' and '{fn}'"
-        return s3(s2(s1)), s3(beta)
+        return infer_application(result, self.arg.infer(context))
     def __repr__(self):
         f = str(self.func)
         a = str(self.arg)
@@ -98,124 +146,328 @@ class Application(Inferrable):
         return f"{f} {a}"
 
 class DependantType(Inferrable):
-    def __init__(self, param: str, term: Term, body: Term) -> None:
-        self.param = param
-        self.term = term
-        self.body = body
+    __slots__ = ("param", "term", "body", "__weakref__")
+    KIND = 2
+    def __new__(cls, param: str, term: Term, body: Term) -> 'DependantType':
+        key = (param, id(term), id(body))
+        self = _DEP_CACHE.get(key)
+        if self is None:
+            self = super().__new__(cls)
+            self.param = param
+            self.term = term
+            self.body = body
+            _DEP_CACHE[key] = self
+        return self
     def infer(self, context: 'Context') -> InferenceResult:
-        context = Context(context.mapping.copy())
         result = self.term.infer(context)
         if isinstance(result, str): return result
-        s1, t1 = result
-        context.mapping[self.param] = t1
-        result = self.body.infer(context)
-        if isinstance(result, str): return result
-        s2, t2 = result
-        return s2(s1), DependantType(self.param, t1, t2)
+        _, t1 = result
+        with context.extend(self.param, t1):
+            result = self.body.infer(context)
+        return infer_dependant(self.param, t1, result)
     def __repr__(self):
         return f"|{self.param}: {self.term}. {self.body}"
 
+class Telescope(Inferrable):
+    # `|p1: t1. ... |pn: tn. body` as one node; `unfold` gives the
+    # equivalent outermost DependantType when the two forms meet
+    __slots__ = ("params", "body", "__weakref__")
+    KIND = 7
+    def __new__(cls, params: tuple[tuple[str, Term], ...], body: Term) -> 'Telescope':
+        key = (tuple((p, id(t)) for p, t in params), id(body))
+        self = _TEL_CACHE.get(key)
+        if self is None:
+            self = super().__new__(cls)
+            self.params = params
+            self.body = body
+            _TEL_CACHE[key] = self
+        return self
+    def unfold(self) -> 'DependantType':
+        (param, type), *rest = self.params
+        body = Telescope(tuple(rest), self.body) if rest else self.body
+        return DependantType(param, type, body)
+    def infer(self, context: 'Context') -> InferenceResult:
+        params = []
+        with ExitStack() as scope:
+            for param, term in self.params:
+                result = term.infer(context)
+                if isinstance(result, str): return result
+                _, t = result
+                params.append((param, t))
+                scope.enter_context(context.extend(param, t))
+            result = self.body.infer(context)
+        if isinstance(result, str): return result
+        _, body = result
+        return _EMPTY_SUBST, Telescope(tuple(params), body)
+    def __repr__(self):
+        params = "".join(f"|{p}: {t}. " for p, t in self.params)
+        return f"{params}{self.body}"
+
 class WildCard(Inferrable):
+    __slots__ = ()
+    KIND = 6
     def __init__(self):
         pass
     def infer(self, context: 'Context') -> InferenceResult:
         context = context
-        return Substitution(), Var()
+        return _EMPTY_SUBST, Var()
     def __repr__(self):
         return "?"
 
+# inference rules shared by the Term nodes above and by callers that infer
+# straight from a parse tree; each takes its sub-results already inferred
+
+def infer_var(name: str, context: 'Context') -> InferenceResult:
+    if name in context.mapping:
+        return _EMPTY_SUBST, context.instantiate(name)
+    return f"Unbound variable: {name}"
+
+def infer_abstraction(type: Term, body: InferenceResult) -> InferenceResult:
+    if isinstance(body, str): return body
+    _, t1 = body
+    return _EMPTY_SUBST, TypeConstructor("->", [type, t1])
+
+def infer_application(func: InferenceResult, arg: InferenceResult) -> InferenceResult:
+    if isinstance(func, str): return func
+    _, t1 = func
+    if isinstance(arg, str): return arg
+    _, t2 = arg
+    beta = Var()
+    fn = TypeConstructor("->", [t2, beta])
+    s3 = unify(t1, fn)
+    if s3 is None:
+        return f"Failed unification of function types: '{t1}' and '{fn}'"
+    return _EMPTY_SUBST, s3(beta)
+
+def infer_dependant(param: str, term: Term, body: InferenceResult) -> InferenceResult:
+    if isinstance(body, str): return body
+    _, t2 = body
+    return _EMPTY_SUBST, DependantType(param, term, t2)
+
 class Substitution:
-    def __init__(self, mapping: dict[str, Term] = {}) -> None:
-        self.mapping = mapping
-    @overload
-    def __call__(self, x: Term) -> Term: ...
-    @overload
-    def __call__(self, x: 'Substitution') -> 'Substitution': ...
-    def __call__(self, x):
-        if isinstance(x, Var):
-            if x.name in self.mapping:
-                return self.mapping[x.name]
-            return x
-        if isinstance(x, TypeConstructor):
-            args = [self(a) for a in x.args]
-            return TypeConstructor(x.name, args)
-        if isinstance(x, DependantType):
-            type = self(x.term)
-            body = self(x.body)
-            return DependantType(x.param, type, body)
-        if isinstance(x, Nat):
-            return x
-        if isinstance(x, Application):
-            return Application(self(x.func), self(x.arg))
-        if isinstance(x, Substitution):
-            s = self.mapping.copy()
-            for k, v in x.mapping.items():
-                s[k] = self(v)
-            return Substitution(s)
+    __slots__ = ("mapping", "rank")
+    def __init__(self, mapping: Optional[dict[int, Term]] = None) -> None:
+        self.mapping = {} if mapping is None else mapping
+        self.rank: Optional[dict[int, int]] = None
+    def find(self, x: Term) -> Term:
+        path = []
+        while x.KIND == Var.KIND and x.id in self.mapping:
+            path.append(x.id)
+            x = self.mapping[x.id]
+        for id in path:
+            self.mapping[id] = x
+        return x
+    def bind(self, var: Var, x: Term) -> None:
+        if x.KIND == Var.KIND:
+            if self.rank is None: self.rank = {}
+            r1 = self.rank.get(var.id, 0)
+            r2 = self.rank.get(x.id, 0)
+            if r1 > r2:
+                self.mapping[x.id] = var
+                return
+            if r1 == r2:
+                self.rank[x.id] = r2 + 1
+        self.mapping[var.id] = x
+    def __call__(self, x: Term) -> Term:
+        if not self.mapping: return x
+        return self.apply(x)
+    def apply(self, root: Term) -> Term:
+        # iterative post-order walk, memoized by node so shared subtrees
+        # are only rebuilt once
+        results: list[Term] = []
+        memo: dict[int, Term] = {}
+        stack: list[tuple[Term, bool]] = [(root, False)]
+        while stack:
+            x, visited = stack.pop()
+            if visited and x.KIND == Var.KIND:
+                memo[id(x)] = results[-1]
+                continue
+            if visited:
+                old = _children(x)
+                kids = results[len(results) - len(old):]
+                del results[len(results) - len(old):]
+                y = x if all(a is b for a, b in zip(kids, old)) else _rebuild(x, kids)
+                memo[id(x)] = y
+                results.append(y)
+                continue
+            if id(x) in memo:
+                results.append(memo[id(x)])
+                continue
+            if x.KIND == Var.KIND:
+                r = self.find(x)
+                if r is x:
+                    results.append(x)
+                    continue
+                stack.append((x, True))
+                stack.append((r, False))
+                continue
+            children = _children(x)
+            if children is None:
+                results.append(x)
+                continue
+            stack.append((x, True))
+            stack.extend((c, False) for c in reversed(children))
+        return results[0]
     def __repr__(self) -> str:
-        s = "S("
-        for i, (k, v) in enumerate(self.mapping.items()):
-            if i > 0:
-                s += ", "
-            s += f"{k} |-> {v}"
-        return s + ")"
+        items = ", ".join(f"{k} |-> {v}" for k, v in self.mapping.items())
+        return f"S({items})"
+
+# returned by every rule that binds nothing; the store is read-only, so
+# a unify handed it fails loudly instead of binding into all of them
+_EMPTY_SUBST = Substitution(MappingProxyType({}))
+_NAT_TY = TypeConstructor("Nat")
+_NAT_RESULT: InferenceResult = (_EMPTY_SUBST, _NAT_TY)
+
+def _children(x: Term) -> list[Term] | None:
+    match x.KIND:
+        case TypeConstructor.KIND:
+            return x.args
+        case DependantType.KIND:
+            return [x.term, x.body]
+        case Abstraction.KIND:
+            return [x.type, x.body]
+        case Application.KIND:
+            return [x.func, x.arg]
+        case Telescope.KIND:
+            return [t for _, t in x.params] + [x.body]
+    return None
+
+def _rebuild(x: Term, kids: list[Term]) -> Term:
+    match x.KIND:
+        case TypeConstructor.KIND:
+            return TypeConstructor(x.name, kids)
+        case DependantType.KIND:
+            return DependantType(x.param, kids[0], kids[1])
+        case Abstraction.KIND:
+            return Abstraction(x.param, kids[0], kids[1])
+        case Telescope.KIND:
+            params = tuple((p, t) for (p, _), t in zip(x.params, kids))
+            return Telescope(params, kids[-1])
+    return Application(kids[0], kids[1])
+
+def _free_vars(t: Term) -> list[Var]:
+    found: dict[int, Var] = {}
+    seen: set[int] = set()
+    stack = [t]
+    while stack:
+        x = stack.pop()
+        if id(x) in seen: continue
+        seen.add(id(x))
+        if x.KIND == Var.KIND:
+            found.setdefault(x.id, x)
+            continue
+        children = _children(x)
+        if children: stack.extend(children)
+    return list(found.values())
+
+def occurs(var: Var, t: Term, s: Substitution) -> bool:
+    seen: set[int] = set()
+    stack = [t]
+    while stack:
+        x = s.find(stack.pop())
+        if id(x) in seen: continue
+        seen.add(id(x))
+        if x.KIND == Var.KIND:
+            if x.id == var.id: return True
+            continue
+        children = _children(x)
+        if children: stack.extend(children)
+    return False
 
 class Context:
-    def __init__(self, mapping: dict[str, Term]) -> None:
+    __slots__ = ("mapping", "schemes", "shadowed")
+    def __init__(self, mapping: Optional[dict[str, Term]] = None) -> None:
+        if mapping is None: mapping = {}
         mapping["Nat"] = TypeConstructor("Type", [])
         mapping["true"] = TypeConstructor("Bool")
         mapping["false"] = TypeConstructor("Bool")
         mapping["Bool"] = TypeConstructor("Type")
         self.mapping = mapping
+        # variables of each defined type, which every use gets fresh copies of
+        self.schemes: dict[str, list[Var]] = {}
+        self.shadowed: list[tuple[str, Optional[Term], Optional[list[Var]]]] = []
+    def define(self, name: str, type: Term) -> None:
+        self.mapping[name] = type
+        free = _free_vars(type)
+        if free:
+            self.schemes[name] = free
+        else:
+            self.schemes.pop(name, None)
+    def instantiate(self, name: str) -> Term:
+        type = self.mapping[name]
+        free = self.schemes.get(name)
+        if not free: return type
+        return Substitution({v.id: Var(v.name, fresh=True) for v in free})(type)
+    def extend(self, name: str, type: Term) -> 'Context':
+        # binds `name` in place; leaving the `with` block restores the
+        # previous binding, so entering a scope never copies the mapping
+        self.shadowed.append((name, self.mapping.get(name), self.schemes.pop(name, None)))
+        self.mapping[name] = type
+        return self
+    def __enter__(self) -> 'Context':
+        return self
+    def __exit__(self, *_) -> None:
+        name, old, scheme = self.shadowed.pop()
+        if old is None:
+            del self.mapping[name]
+        else:
+            self.mapping[name] = old
+        if scheme is not None:
+            self.schemes[name] = scheme
     def __repr__(self) -> str:
-        s = "T("
-        for i, (k, v) in enumerate(self.mapping.items()):
-            if i > 0:
-                s += ", "
-            s += f"{k} |-> {v}"
-        return s + ")"
+        items = ", ".join(f"{k} |-> {v}" for k, v in self.mapping.items())
+        return f"T({items})"
     
 
-def unify(t1: Term, t2: Term) -> Substitution | None:
-    if isinstance(t2, WildCard) or isinstance(t1, WildCard):
-        return Substitution()
-    if isinstance(t1, Var) and isinstance(t2, Var) and t1.name == t2.name:
-        return Substitution()
-    if isinstance(t2, Var):
-        return Substitution({t2.name: t1})
-    if isinstance(t1, Var):
-        return unify(t2, t1)
-    if isinstance(t1, TypeConstructor) and isinstance(t2, TypeConstructor):
-        if t1.name != t2.name: return None
-        if len(t1.args) != len(t2.args): return None
-        s = Substitution()
-        for a1, a2 in zip(t1.args, t2.args):
-            result = unify(a1, a2)
-            if result is None: return None
-            s = s(result)
-        return s
-    if isinstance(t1, DependantType) and isinstance(t2, DependantType):
-        s = {}
-        result = unify(t1.term, t2.term)
-        if result is None: return None
-        s |= result.mapping
-        result = unify(t1.body, t2.body)
-        if result is None: return None
-        s |= result.mapping
-        return Substitution(s)
-    if isinstance(t1, Nat) and isinstance(t2, Nat):
-        if t1.value != t2.value: return None
-        return Substitution()
-    if isinstance(t1, Abstraction) and isinstance(t2, Abstraction):        return unify(t1.body, t2.body)
-    if isinstance(t1, Application) and isinstance(t2, Application):
+def unify(t1: Term, t2: Term, s: Optional[Substitution] = None) -> Substitution | None:
+    if s is None:
         s = Substitution()
-        result = unify(t1.func, t2.func)
-        if result is None: return None
-        s = result(s)
-        result = unify(t1.arg, t2.arg)
-        if result is None: return None
-        s = result(s)
-        return s
-
-        
-    return None
+    # the last child of each node is unified by looping rather than
+    # recursing, so right-nested chains like `a -> b -> c` stay flat
+    while True:
+        t1, t2 = s.find(t1), s.find(t2)
+        if t1 is t2:
+            return s
+        match (t1.KIND, t2.KIND):
+            case (WildCard.KIND, _) | (_, WildCard.KIND):
+                return s
+            case (Var.KIND, Var.KIND) if t1.id == t2.id:
+                return s
+            case (_, Var.KIND):
+                if t1.KIND != Var.KIND and occurs(t2, t1, s): return None
+                s.bind(t2, t1)
+                return s
+            case (Var.KIND, _):
+                t1, t2 = t2, t1
+            case (TypeConstructor.KIND, TypeConstructor.KIND):
+                if t1.name != t2.name: return None
+                if len(t1.args) != len(t2.args): return None
+                if not t1.args: return s
+                for i in range(len(t1.args) - 1):
+                    a1, a2 = t1.args[i], t2.args[i]
+                    if a1 is a2: continue
+                    if unify(a1, a2, s) is None: return None
+                t1, t2 = t1.args[-1], t2.args[-1]
+            case (Telescope.KIND, Telescope.KIND) if len(t1.params) == len(t2.params):
+                for (_, a1), (_, a2) in zip(t1.params, t2.params):
+                    if a1 is a2: continue
+                    if unify(a1, a2, s) is None: return None
+                t1, t2 = t1.body, t2.body
+            case (Telescope.KIND, Telescope.KIND | DependantType.KIND):
+                t1 = t1.unfold()
+            case (DependantType.KIND, Telescope.KIND):
+                t2 = t2.unfold()
+            case (DependantType.KIND, DependantType.KIND):
+                if unify(t1.term, t2.term, s) is None: return None
+                t1, t2 = t1.body, t2.body
+            case (Nat.KIND, Nat.KIND):
+                # Nat is interned by value, so equal literals were already
+                # caught by the identity check above
+                return None
+            case (Abstraction.KIND, Abstraction.KIND):
+                t1, t2 = t1.body, t2.body
+            case (Application.KIND, Application.KIND):
+                if unify(t1.func, t2.func, s) is None: return None
+                t1, t2 = t1.arg, t2.arg
+            case _:
+                return None